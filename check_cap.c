@@ -82,9 +82,31 @@ static int test_avx2(void)
     }
 }
 
+static int test_avx512f(void)
+{
+    fprintf(stderr, "Testing vpaddq on zmm (AVX-512F)...\n");
+    uint64_t words[8] = {1, 2, 3, 4, 5, 6, 7, 8};
+    asm volatile (
+        "vmovdqu64 (%[ptr]), %%zmm0\n"
+        "vpaddq %%zmm0, %%zmm0, %%zmm0\n"
+        "vmovdqu64 %%zmm0, (%[ptr])\n"
+        : /*no outputs*/
+        : [ptr] "r" ((uint64_t *) words)
+        : "zmm0", "cc", "memory"
+    );
+    for (int i = 0; i < 8; ++i) {
+        if (words[i] != (uint64_t) (2 * (i + 1))) {
+            fprintf(stderr, "vpaddq gave unexpected result.\n");
+            return 1;
+        }
+    }
+    fprintf(stderr, "vpaddq is supported.\n");
+    return 0;
+}
+
 static void print_usage(void)
 {
-    fprintf(stderr, "USAGE: check_cap {bmi2 | adx | avx | avx2}\n");
+    fprintf(stderr, "USAGE: check_cap {bmi2 | adx | avx | avx2 | avx512f}\n");
 }
 
 int main(int argc, char **argv)
@@ -111,6 +133,10 @@ int main(int argc, char **argv)
         return test_avx2();
     }
 
+    if (strcmp(arg, "avx512f") == 0) {
+        return test_avx512f();
+    }
+
     print_usage();
     return 2;
 }
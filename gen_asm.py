@@ -1,19 +1,21 @@
 #!/usr/bin/env python3
 import os
 import sys
+import functools
 import subprocess
-from typing import List, Union, Optional, Tuple
+from typing import List, Union, Optional, Tuple, Iterable
 
 
 class RegList:
     def __init__(self, names: List[str]):
         self._names = names
+        self._indices = {name: index for index, name in enumerate(names)}
 
     def name_by_index(self, index: int) -> str:
         return self._names[index]
 
     def index_by_name(self, name: str) -> int:
-        return self._names.index(name)
+        return self._indices[name]
 
     def names(self) -> List[str]:
         return self._names
@@ -43,53 +45,80 @@ class RealReg(Reg):
     def __init__(self, index: int):
         self.index = index
 
-    def __str__(self):
-        return f'%{ALL_REGS.name_by_index(self.index)}'
+        name = ALL_REGS.name_by_index(index)
+        self._str = f'%{name}'
 
-    def e_part(self):
-        base_name = str(self).lstrip('%r')
+        base_name = name.lstrip('r')
         if base_name.isdigit():
             # %r8 -> r8d
-            return f'%r{base_name}d'
-        else:
-            # %rax -> %eax
-            return f'%e{base_name}'
-
-    def l_part(self):
-        base_name = str(self).lstrip('%r')
-        if base_name.isdigit():
+            self._e = f'%r{base_name}d'
             # %r8 -> r8b
-            return f'%r{base_name}b'
+            self._l = f'%r{base_name}b'
         else:
+            # %rax -> %eax
+            self._e = f'%e{base_name}'
             if 'x' in base_name:
                 # %rax -> %al
-                return f'%{base_name.rstrip("x")}l'
+                self._l = f'%{base_name.rstrip("x")}l'
             else:
                 # %rdi -> %dil
-                return f'%{base_name}l'
+                self._l = f'%{base_name}l'
+
+    def __str__(self) -> str:
+        return self._str
+
+    def e_part(self) -> str:
+        return self._e
+
+    def l_part(self) -> str:
+        return self._l
 
 
 class FakeReg(Reg):
     def __init__(self, keyword: str):
         self.keyword = keyword
+        self._str = f'![{keyword}]'
+        self._e = f'!k[{keyword}]'
+        self._l = f'!b[{keyword}]'
 
-    def __str__(self):
-        return f'![{self.keyword}]'
+    def __str__(self) -> str:
+        return self._str
 
-    def e_part(self):
-        return f'!k[{self.keyword}]'
+    def e_part(self) -> str:
+        return self._e
 
-    def l_part(self):
-        return f'!b[{self.keyword}]'
+    def l_part(self) -> str:
+        return self._l
 
 
 class NoVacantReg(BaseException):
     pass
 
 
+def regs_mask(reg_list: RegList) -> int:
+    result = 0
+    for name in reg_list.names():
+        result |= 1 << ALL_REGS.index_by_name(name)
+    return result
+
+
+CALLEE_SAVED_REGS_MASK = regs_mask(CALLEE_SAVED_REGS)
+
+
+def take_highest_bit(mask: int) -> int:
+    if not mask:
+        raise NoVacantReg()
+    return mask.bit_length() - 1
+
+
 class RegStore:
-    def __init__(self, reg_list: RegList=SCRATCH_REGS):
-        self.free_indices = [ALL_REGS.index_by_name(name) for name in reg_list.names()]
+    def __init__(self, reg_list: RegList=SCRATCH_REGS, reserved_reg_list: RegList=CALLEE_SAVED_REGS):
+        # Bit 'i' is set iff register with index 'i' in ALL_REGS is free.
+        self.free_mask = regs_mask(reg_list)
+        # Registers that are only handed out when explicitly preferred (see 'take').
+        self.reserved_regs_mask = regs_mask(reserved_reg_list)
+        # Same as 'free_mask', but for the reserved registers.
+        self.free_reserved_mask = self.reserved_regs_mask
         self.writes = set()
 
     def _set_reg_mode(self, reg: RealReg, write: bool) -> None:
@@ -101,30 +130,36 @@ class RegStore:
             index = ALL_REGS.index_by_name(reg_name)
             self.writes.add(index)
 
-    def take(self, write: bool) -> RealReg:
+    # 'prefer_mask' is a mask of registers (see 'regs_mask') to take from first, reserved or not.
+    def take(self, write: bool, prefer_mask: int=0) -> RealReg:
         # TODO this heuristic works for now, but could be made configurable
-        where = -1
-        try:
-            reg = RealReg(self.free_indices.pop(where))
-        except IndexError:
-            raise NoVacantReg()
-        self._set_reg_mode(reg, write=write)
-        return reg
+        if prefer_mask:
+            mask = (self.free_mask | self.free_reserved_mask) & prefer_mask
+            if mask:
+                return self.take_by_index(take_highest_bit(mask), write=write)
+        return self.take_by_index(take_highest_bit(self.free_mask), write=write)
 
     def untake(self, reg: RealReg) -> None:
-        self.free_indices.append(reg.index)
-        self.free_indices.sort()
+        bit = 1 << reg.index
+        if self.reserved_regs_mask & bit:
+            self.free_reserved_mask |= bit
+        else:
+            self.free_mask |= bit
 
     def take_by_index(self, index: int, write: bool) -> RealReg:
-        self.free_indices.remove(index)
+        bit = 1 << index
+        if self.free_mask & bit:
+            self.free_mask &= ~bit
+        elif self.free_reserved_mask & bit:
+            self.free_reserved_mask &= ~bit
+        else:
+            raise ValueError(f'register {ALL_REGS.name_by_index(index)} is not free')
         reg = RealReg(index)
         self._set_reg_mode(reg, write=write)
         return reg
 
     def take_by_name(self, name: str, write: bool) -> RealReg:
-        reg = self.take_by_index(ALL_REGS.index_by_name(name), write=write)
-        self._set_reg_mode(reg, write=write)
-        return reg
+        return self.take_by_index(ALL_REGS.index_by_name(name), write=write)
 
     def clobbers(self) -> List[str]:
         return [ALL_REGS.name_by_index(index) for index in self.writes]
@@ -138,31 +173,68 @@ class PointerReg(AnyPointerReg):
     def __init__(self, reg: Reg, offset: int=0):
         self.reg = reg
         self.offset = offset
-
-    def __str__(self):
-        if self.offset:
-            return f'{self.offset * 8}({self.reg})'
+        if offset:
+            self._str = f'{offset * 8}({reg})'
         else:
-            return f'({self.reg})'
-
-    def displace(self, offset: int):
-        return PointerReg(reg=self.reg, offset=self.offset + offset)
+            self._str = f'({reg})'
+        # offset -> displaced pointer; emission displaces a base pointer by the same offsets a lot.
+        self._displaced = {}
+
+    def __str__(self) -> str:
+        return self._str
+
+    def displace(self, offset: int) -> 'PointerReg':
+        result = self._displaced.get(offset)
+        if result is None:
+            result = PointerReg(reg=self.reg, offset=self.offset + offset)
+            self._displaced[offset] = result
+        return result
 
 
 class Emitter:
-    pass
+    def __init__(self):
+        self._buf = []
+        self.vector_regs = []
+        self.mask_regs = []
+
+    def emit(self, line: str) -> None:
+        raise NotImplementedError()
+
+    def emit_many(self, lines: Iterable[str]) -> None:
+        for line in lines:
+            self.emit(line)
+
+    # Vector and mask registers are simply handed out in order: in the standalone listing, they are
+    # all caller-saved, and in inline asm, the ones taken are declared as clobbers.
+    def take_vector_reg(self, kind: str='ymm') -> str:
+        name = f'{kind}{len(self.vector_regs)}'
+        self.vector_regs.append(name)
+        return f'%{name}'
+
+    def take_mask_reg(self) -> str:
+        # '%k0' cannot be used as a write mask.
+        name = f'k{len(self.mask_regs) + 1}'
+        self.mask_regs.append(name)
+        return f'%{name}'
+
+    def flush(self) -> None:
+        if self._buf:
+            sys.stdout.write('\n'.join(self._buf))
+            sys.stdout.write('\n')
+            self._buf.clear()
 
 
 class SysvAbiFunctionEmitter(Emitter):
     label_counter = 0
 
     def __init__(self):
+        super().__init__()
         self.reg_store = RegStore()
-        self.fixed_regs = []
+        self.fixed_regs = set()
         self.arg_map = SYSV_ABI_ARG_REGS.names()
 
     def add_fixed_reg(self, reg_name: str) -> None:
-        self.fixed_regs.append(reg_name)
+        self.fixed_regs.add(reg_name)
 
     def take_zero_reg(self) -> Reg:
         reg = self.reg_store.take(write=True)
@@ -213,10 +285,20 @@ class SysvAbiFunctionEmitter(Emitter):
         pass
 
     def emit(self, line: str) -> None:
-        print(line)
+        self._buf.append(line)
+
+    def emit_many(self, lines: Iterable[str]) -> None:
+        self._buf.extend(lines)
 
     def emit_epilogue(self) -> None:
-        pass
+        saved = [
+            name
+            for name in CALLEE_SAVED_REGS.names()
+            if ALL_REGS.index_by_name(name) in self.reg_store.writes
+        ]
+        self._buf[0:0] = [f'pushq %{name}' for name in saved]
+        for name in reversed(saved):
+            self.emit(f'popq %{name}')
 
     def gen_label(self) -> str:
         self.__class__.label_counter += 1
@@ -225,6 +307,9 @@ class SysvAbiFunctionEmitter(Emitter):
     def label_here(self, label: str) -> None:
         self.emit(f'{label}:')
 
+    def emit_vzeroupper(self) -> None:
+        self.emit('vzeroupper')
+
 
 REG_NAMES_TO_LETTERS = {
     'rax': 'a',
@@ -238,11 +323,14 @@ REG_NAMES_TO_LETTERS = {
 
 class InlineAsmEmitter(Emitter):
     def __init__(self):
-        self.reg_store = RegStore()
+        super().__init__()
+        # Leave callee-saved registers to the compiler: it needs some for the inputs.
+        self.reg_store = RegStore(reserved_reg_list=RegList([]))
         self.args = []
         self.retval = None
         self.retval_earlyclobber = False
         self.needs_zero_input = False
+        self.clobbers_upper_vector_state = False
         self.label_counter = 0
 
     def add_fixed_reg(self, reg_name: str) -> None:
@@ -259,6 +347,9 @@ class InlineAsmEmitter(Emitter):
         if len(self.args) != index:
             raise ValueError('wrong order of arg indices')
         self.args.append((write, into_reg_name or ''))
+        if into_reg_name is not None:
+            # The compiler puts the argument there; keep it from being handed out as a scratch.
+            self.reg_store.take_by_name(into_reg_name, write=False)
         return FakeReg(f'arg{index}')
 
     def take_retval_reg(self, may_overwrite_taken: bool=True) -> FakeReg:
@@ -276,12 +367,14 @@ class InlineAsmEmitter(Emitter):
         self.emit(f'movq {src_reg}, ![ret]')
 
     def emit_prologue(self) -> None:
-        print('    asm volatile (')
+        self._buf.append('    asm volatile (')
 
     def emit(self, line: str) -> None:
         line = line.replace('%', '%%')
         line = line.replace('!', '%')
-        print(f'    "{line}\\n"')
+        # Braces (as in AVX-512 write masks) would otherwise denote assembler dialect alternatives.
+        line = line.replace('{', '%{').replace('}', '%}')
+        self._buf.append(f'    "{line}\\n"')
 
     def emit_epilogue(self) -> None:
         clobbers = self.reg_store.clobbers()
@@ -319,15 +412,25 @@ class InlineAsmEmitter(Emitter):
         if self.needs_zero_input:
             inputs.append('[zero] "r" ((uint64_t) 0)')
 
+        clobbers.extend(self.vector_regs)
+        if self.clobbers_upper_vector_state:
+            taken = {int(name[3:]) for name in self.vector_regs}
+            clobbers.extend(f'ymm{i}' for i in range(16) if i not in taken)
         clobbers.append('cc')
         clobbers.append('memory')
         clobbers.sort()
         clobbers = [f'"{s}"' for s in clobbers]
 
-        print(f'    : {", ".join(outputs) or "/*no outputs*/"}')
-        print(f'    : {", ".join(inputs) or "/*no inputs*/"}')
-        print(f'    : {", ".join(clobbers) or "/*no clobbers*/"}')
-        print('    );')
+        self._buf.append(f'    : {", ".join(outputs) or "/*no outputs*/"}')
+        self._buf.append(f'    : {", ".join(inputs) or "/*no inputs*/"}')
+        self._buf.append(f'    : {", ".join(clobbers) or "/*no clobbers*/"}')
+        if self.mask_regs:
+            # GCC refuses mask register clobbers unless it targets AVX-512; if it does not, it does
+            # not allocate them either.
+            self._buf.append('#ifdef __AVX512F__')
+            self._buf.append('    , ' + ', '.join(f'"{s}"' for s in self.mask_regs))
+            self._buf.append('#endif')
+        self._buf.append('    );')
 
     def gen_label(self) -> str:
         self.label_counter += 1
@@ -336,10 +439,58 @@ class InlineAsmEmitter(Emitter):
     def label_here(self, label: str) -> None:
         self.emit(f'{label}:')
 
+    def emit_vzeroupper(self) -> None:
+        # The compiler never looks inside the asm statement, so it cannot clean the upper vector
+        # state after it; leaving it dirty slows down the caller's SSE code. 'vzeroupper' clears
+        # the upper halves of all of ymm0-15, so they are all declared as clobbers (see 'emit_epilogue').
+        self.emit('vzeroupper')
+        self.clobbers_upper_vector_state = True
+
 
 #------------------------------------------------------------------------------
 
 
+# Returns operand strings for 'src[0]...src[n]', where 'src' is either a pointer or a list of
+# registers holding the limbs (see 'load_src_regs').
+def limb_operands(src: Union[AnyPointerReg, List[Reg]], n: int) -> List[str]:
+    if isinstance(src, list):
+        return [str(reg) for reg in src[:n]]
+    else:
+        return [str(src.displace(i)) for i in range(n)]
+
+
+# Loads 'a[0]...a[n]' into registers so that they can be reused across multiple rows of a long
+# multiplication, but only if at least 'reserve' scratch registers would still be free afterwards.
+#
+# Scratch registers are used first; the rest are callee-saved ones, which the emitter has to save
+# and restore, but which stay "taken" for the whole multiplication anyway.
+#
+# On success, "untakes" 'reg_a' and returns the list of registers; otherwise, returns 'a' itself.
+def load_src_regs(
+        emitter: Emitter,
+        reg_a: Reg,
+        a: AnyPointerReg,
+        n: int,
+        reserve: int) -> Union[AnyPointerReg, List[Reg]]:
+
+    nfree = bin(emitter.reg_store.free_mask).count('1')
+    nreserved = bin(emitter.reg_store.free_reserved_mask).count('1')
+    frees_reg_a = isinstance(reg_a, RealReg)
+    nscratch = max(0, min(n, nfree, nfree + frees_reg_a - reserve))
+    if nscratch + nreserved < n:
+        return a
+
+    src_regs = [emitter.reg_store.take(write=True) for _ in range(nscratch)]
+    src_regs += [
+        emitter.reg_store.take(write=True, prefer_mask=CALLEE_SAVED_REGS_MASK)
+        for _ in range(n - nscratch)
+    ]
+    emitter.emit_many(f'movq {a.displace(i)}, {src_regs[i]}' for i in range(n))
+    if frees_reg_a:
+        emitter.reg_store.untake(reg_a)
+    return src_regs
+
+
 # Multiply 'src[0]...src[n]' by 'mulby', writing/adding result to 'dst[0]...dst[n]'.
 #
 # If 'i >= undef_from', then the value of 'dst[i]' is assumed to be "undefined" (but implicitly
@@ -353,7 +504,7 @@ def mul_aux(
         emitter: Emitter,
         n: int,
         undef_from: int,
-        src: AnyPointerReg,
+        src: Union[AnyPointerReg, List[Reg]],
         mulby: Union[Reg, AnyPointerReg],
         dst: AnyPointerReg,
         zero: Union[Reg, str],
@@ -364,6 +515,9 @@ def mul_aux(
 
     reg_carry = emitter.reg_store.take(write=True)
 
+    src_s = limb_operands(src, n)
+    dst_s = [str(dst.displace(i)) for i in range(n)]
+
     for i in range(n):
         drop_following_carry = drop_last_carry and (i + 1 == n)
 
@@ -373,9 +527,9 @@ def mul_aux(
         emitter.emit(f'movq {mulby}, {rax}')
 
         if drop_following_carry:
-            emitter.emit(f'imulq {src.displace(i)}, {rax}')
+            emitter.emit(f'imulq {src_s[i]}, {rax}')
         else:
-            emitter.emit(f'mulq {src.displace(i)}')
+            emitter.emit(f'mulq {src_s[i]}')
 
         if i:
             emitter.emit(f'addq {reg_carry}, {rax}')
@@ -383,9 +537,9 @@ def mul_aux(
                 emitter.emit(f'adcq {zero}, {rdx}')
 
         if i >= undef_from:
-            emitter.emit(f'movq {rax}, {dst.displace(i)}')
+            emitter.emit(f'movq {rax}, {dst_s[i]}')
         else:
-            emitter.emit(f'addq {rax}, {dst.displace(i)}')
+            emitter.emit(f'addq {rax}, {dst_s[i]}')
             if not drop_following_carry:
                 emitter.emit(f'adcq {zero}, {rdx}')
 
@@ -402,7 +556,7 @@ def mul_aux_bmi2(
         emitter: Emitter,
         n: int,
         undef_from: int,
-        src: AnyPointerReg,
+        src: Union[AnyPointerReg, List[Reg]],
         rdx: Reg,
         dst: AnyPointerReg,
         zero: Union[Reg, str],
@@ -419,10 +573,13 @@ def mul_aux_bmi2(
 
     cy_meaningful = False
 
+    src_s = limb_operands(src, n)
+    dst_s = [str(dst.displace(i)) for i in range(n)]
+
     for i in range(n):
         drop_following_carry = drop_last_carry and (i + 1 == n)
 
-        emitter.emit(f'mulxq {src.displace(i)}, {reg_lo}, {reg_hi}')
+        emitter.emit(f'mulxq {src_s[i]}, {reg_lo}, {reg_hi}')
 
         if i:
             insn = 'adcq' if cy_meaningful else 'addq'
@@ -430,11 +587,11 @@ def mul_aux_bmi2(
             cy_meaningful = True
 
         if i >= undef_from:
-            emitter.emit(f'movq {reg_lo}, {dst.displace(i)}')
+            emitter.emit(f'movq {reg_lo}, {dst_s[i]}')
         else:
             if cy_meaningful and not drop_following_carry:
                 emitter.emit(f'adcq {zero}, {reg_hi}')
-            emitter.emit(f'addq {reg_lo}, {dst.displace(i)}')
+            emitter.emit(f'addq {reg_lo}, {dst_s[i]}')
             cy_meaningful = True
 
         reg_hi, reg_carry = reg_carry, reg_hi
@@ -447,6 +604,64 @@ def mul_aux_bmi2(
     return reg_carry, cy_meaningful
 
 
+# Same as 'mul_aux_bmi2', but uses two independent carry chains: CF (via 'adcx') accumulates
+# 'dst[i]', and OF (via 'adox') accumulates the high halves of the products.
+#
+# 'zero' must be a register with value of zero; it may only be None if 'drop_last_carry' is True, or
+# if 'n' is 1 and all of 'dst' is undefined.
+#
+# If 'drop_last_carry' is False (default), returns register with last carry; you must "untake" it.
+# Otherwise, returns None.
+def mul_aux_adx(
+        emitter: Emitter,
+        n: int,
+        undef_from: int,
+        src: Union[AnyPointerReg, List[Reg]],
+        rdx: Reg,
+        dst: AnyPointerReg,
+        zero: Optional[Reg],
+        drop_last_carry: bool=False) -> Optional[Reg]:
+
+    reg_lo = emitter.reg_store.take(write=True)
+    reg_hi = emitter.reg_store.take(write=True)
+    reg_carry = emitter.reg_store.take(write=True)
+
+    cf_meaningful = undef_from > 0
+    of_meaningful = n > 1
+
+    if cf_meaningful or of_meaningful:
+        # Clears both CF and OF.
+        emitter.emit(f'xorl {reg_lo.e_part()}, {reg_lo.e_part()}')
+
+    src_s = limb_operands(src, n)
+    dst_s = [str(dst.displace(i)) for i in range(n)]
+
+    for i in range(n):
+        emitter.emit(f'mulxq {src_s[i]}, {reg_lo}, {reg_hi}')
+
+        if i < undef_from:
+            emitter.emit(f'adcxq {dst_s[i]}, {reg_lo}')
+
+        if i:
+            emitter.emit(f'adoxq {reg_carry}, {reg_lo}')
+
+        emitter.emit(f'movq {reg_lo}, {dst_s[i]}')
+
+        reg_hi, reg_carry = reg_carry, reg_hi
+
+    emitter.reg_store.untake(reg_lo)
+    emitter.reg_store.untake(reg_hi)
+    if drop_last_carry:
+        emitter.reg_store.untake(reg_carry)
+        return None
+
+    if cf_meaningful:
+        emitter.emit(f'adcxq {zero}, {reg_carry}')
+    if of_meaningful:
+        emitter.emit(f'adoxq {zero}, {reg_carry}')
+    return reg_carry
+
+
 def mul_aux_auto(
         emitter: Emitter,
         n: int,
@@ -498,7 +713,7 @@ def long_mul_step_bmi2(
         emitter: Emitter,
         n: int,
         undef_from: int,
-        src: AnyPointerReg,
+        src: Union[AnyPointerReg, List[Reg]],
         rdx: Reg,
         dst: AnyPointerReg,
         zero: Union[Reg, str]) -> None:
@@ -520,6 +735,29 @@ def long_mul_step_bmi2(
     emitter.reg_store.untake(reg_last_carry)
 
 
+def long_mul_step_adx(
+        emitter: Emitter,
+        n: int,
+        undef_from: int,
+        src: Union[AnyPointerReg, List[Reg]],
+        rdx: Reg,
+        dst: AnyPointerReg,
+        zero: Optional[Reg]) -> None:
+
+    reg_last_carry = mul_aux_adx(
+        emitter,
+        n, undef_from,
+        src, rdx, dst,
+        zero)
+
+    if n >= undef_from:
+        emitter.emit(f'movq {reg_last_carry}, {dst.displace(n)}')
+    else:
+        emitter.emit(f'addq {reg_last_carry}, {dst.displace(n)}')
+
+    emitter.reg_store.untake(reg_last_carry)
+
+
 #------------------------------------------------------------------------------
 
 
@@ -538,7 +776,7 @@ def FUNC_mul(emitter, n, m):
     b = PointerReg(reg_b)
     dst = PointerReg(reg_dst)
 
-    zero = '$0'
+    zero = emitter.take_zero_reg() if n > 1 else '$0'
 
     for i in range(m):
         if i:
@@ -569,7 +807,10 @@ def FUNC_mul_bmi2(emitter, n, m):
 
     rdx = emitter.reg_store.take_by_name('rdx', write=True)
 
-    zero = '$0'
+    zero = emitter.take_zero_reg() if n > 1 else '$0'
+
+    if m > 1:
+        a = load_src_regs(emitter, reg_a, a, n, reserve=3)
 
     for i in range(m):
         if i:
@@ -586,6 +827,43 @@ def FUNC_mul_bmi2(emitter, n, m):
             zero=zero)
 
 
+def FUNC_mul_adx(emitter, n, m):
+    if n < m:
+        raise ValueError('expected n >= m')
+
+    emitter.add_fixed_reg('rdx')
+
+    reg_a = emitter.take_arg_reg(index=0, write=False)
+    reg_b = emitter.take_arg_reg(index=1, write=False)
+    reg_dst = emitter.take_arg_reg(index=2, write=False)
+
+    a = PointerReg(reg_a)
+    b = PointerReg(reg_b)
+    dst = PointerReg(reg_dst)
+
+    rdx = emitter.reg_store.take_by_name('rdx', write=True)
+
+    # For n == 1, there is only one row and it has no carries to fold.
+    zero = emitter.take_zero_reg() if n > 1 else None
+
+    if m > 1:
+        a = load_src_regs(emitter, reg_a, a, n, reserve=3)
+
+    for i in range(m):
+        if i:
+            undef_from = n
+        else:
+            undef_from = 0
+
+        emitter.emit(f'movq {b.displace(i)}, {rdx}')
+
+        long_mul_step_adx(
+            emitter,
+            n, undef_from,
+            a, rdx, dst.displace(i),
+            zero=zero)
+
+
 def FUNC_mul_lo(emitter, n):
     emitter.add_fixed_reg('rax')
     emitter.add_fixed_reg('rdx')
@@ -598,7 +876,7 @@ def FUNC_mul_lo(emitter, n):
     b = PointerReg(reg_b)
     dst = PointerReg(reg_dst)
 
-    zero = '$0'
+    zero = emitter.take_zero_reg() if n > 1 else '$0'
 
     for i in range(n):
         if i:
@@ -627,6 +905,8 @@ def FUNC_mul_lo_bmi2(emitter, n):
 
     rdx = emitter.reg_store.take_by_name('rdx', write=True)
 
+    zero = emitter.take_zero_reg() if n > 1 else '$0'
+
     for i in range(n):
         if i:
             undef_from = n
@@ -639,7 +919,38 @@ def FUNC_mul_lo_bmi2(emitter, n):
             emitter,
             n - i, undef_from,
             a, rdx, dst.displace(i),
-            zero='$0',
+            zero=zero,
+            drop_last_carry=True)
+
+
+# Same as 'FUNC_mul_lo_bmi2', but with the 'adcx'/'adox' rows of 'FUNC_mul_adx'. No carry out of a
+# row is kept, so no zero register is needed either.
+def FUNC_mul_lo_adx(emitter, n):
+    emitter.add_fixed_reg('rdx')
+
+    reg_a = emitter.take_arg_reg(index=0, write=False)
+    reg_b = emitter.take_arg_reg(index=1, write=False)
+    reg_dst = emitter.take_arg_reg(index=2, write=False)
+
+    a = PointerReg(reg_a)
+    b = PointerReg(reg_b)
+    dst = PointerReg(reg_dst)
+
+    rdx = emitter.reg_store.take_by_name('rdx', write=True)
+
+    for i in range(n):
+        if i:
+            undef_from = n
+        else:
+            undef_from = 0
+
+        emitter.emit(f'movq {b.displace(i)}, {rdx}')
+
+        mul_aux_adx(
+            emitter,
+            n - i, undef_from,
+            a, rdx, dst.displace(i),
+            zero=None,
             drop_last_carry=True)
 
 
@@ -651,7 +962,7 @@ def FUNC_mul_q(emitter, n):
     reg_m = emitter.take_arg_reg(index=1, write=False)
     reg_dst = emitter.take_arg_reg(index=2, write=False)
 
-    zero = '$0'
+    zero = emitter.take_zero_reg() if n > 1 else '$0'
 
     src = PointerReg(reg_src)
     dst = PointerReg(reg_dst)
@@ -691,7 +1002,7 @@ def FUNC_mul_q_bmi2(emitter, n):
         emitter.emit(f'adcq $0, {reg_last_carry}')
 
 
-def FUNC_div_q(emitter, n, operation='div'):
+def FUNC_div_q(emitter, n, operation='div', leaky=False):
     emitter.add_fixed_reg('rax')
     emitter.add_fixed_reg('rdx')
 
@@ -713,12 +1024,38 @@ def FUNC_div_q(emitter, n, operation='div'):
 
     emitter.emit(f'xorl {rdx.e_part()}, {rdx.e_part()}')
 
+    if leaky and n > 1:
+        # Skip leading zero limbs of 'a': their quotient limbs are zero and the remainder stays
+        # zero, so no 'divq' is needed. The first non-zero limb jumps into the main sequence with
+        # the limb already loaded into 'rax'.
+        labels = [emitter.gen_label() for _ in range(n)]
+        label_done = emitter.gen_label()
+        for i in reversed(range(n)):
+            emitter.emit(f'movq {a.displace(i)}, {rax}')
+            emitter.emit(f'testq {rax}, {rax}')
+            emitter.emit(f'jnz {labels[i]}')
+            if dst is not None:
+                emitter.emit(f'movq {rax}, {dst.displace(i)}')
+        emitter.emit(f'jmp {label_done}')
+    else:
+        labels = None
+        label_done = None
+
     for i in reversed(range(n)):
-        emitter.emit(f'movq {a.displace(i)}, {rax}')
+        if labels is None:
+            emitter.emit(f'movq {a.displace(i)}, {rax}')
+        else:
+            # The top limb is always entered by a jump.
+            if i != n - 1:
+                emitter.emit(f'movq {a.displace(i)}, {rax}')
+            emitter.label_here(labels[i])
         emitter.emit(f'divq {reg_m}')
         if dst is not None:
             emitter.emit(f'movq {rax}, {dst.displace(i)}')
 
+    if label_done is not None:
+        emitter.label_here(label_done)
+
     emitter.write_retval(rdx)
 
 
@@ -804,6 +1141,8 @@ def FUNC_shr(emitter, n, is_signed=False, use_bmi2=False):
             use_bmi2=use_bmi2)
 
         emitter.emit(f'movq {reg_tmp_1}, {dst.displace(i)}')
+        # The donor already holds the next source limb, so no extra move is emitted: each limb
+        # costs exactly one load, one store, and the shift itself.
         reg_tmp_1, reg_tmp_2 = reg_tmp_2, reg_tmp_1
 
 
@@ -878,6 +1217,9 @@ def FUNC_aors(emitter, n, aors):
     a = PointerReg(reg_a)
     b = PointerReg(reg_b)
 
+    # A single addition is one carry chain: limb 'i + 1' needs the carry out of limb 'i'. So
+    # there is nothing for 'adcx'/'adox' to run in parallel here (and they cannot write to memory);
+    # they only pay off in 'mul_aux_adx', where two independent sums are accumulated.
     for i in range(n):
         emitter.emit(f'movq {b.displace(i)}, {reg_tmp}')
         if i:
@@ -890,6 +1232,9 @@ def FUNC_aors(emitter, n, aors):
 
 
 def aors_masked_aux(emitter, a, b, reg_c, reg_mask, m_regs, aors, save=False, restore=False):
+    # All the loads and masks are emitted before the carry chain: 'andq' clobbers CF, so it cannot
+    # be interleaved with 'adcq'/'sbbq', and issuing every load up front already hides their
+    # latency behind the chain.
     for i in range(len(m_regs)):
         emitter.emit(f'movq {b.displace(i)}, {m_regs[i]}')
         emitter.emit(f'andq {reg_mask}, {m_regs[i]}')
@@ -954,16 +1299,91 @@ def FUNC_aors_masked(emitter, n, aors, m):
     emitter.emit(f'sbbq {ret}, {ret}')
 
 
+# Below this width, moving the carries between mask and general-purpose registers costs more than
+# the scalar 'adcq'/'sbbq' chain.
+AORS_MASKED_AVX512_MIN_WIDTH = 16
+
+
+# Same as 'FUNC_aors_masked', but adds/subtracts eight limbs (one 'zmm' register) at a time; 'n' must
+# be a multiple of eight.
+#
+# The lanes are added/subtracted independently, then the carries between them are resolved in a
+# general-purpose register: with 'g' the lanes that carry out by themselves, 'p' the lanes that
+# would pass an incoming carry on (all ones for add, zero for sub) and 'cin' the carry into the
+# chunk, '((g << 1 | cin) + p) ^ p' has bit 'i' set iff lane 'i' gets a carry in, and bit 8 set iff
+# the chunk carries out. A lane cannot be in both 'g' and 'p'.
+def FUNC_aors_masked_avx512(emitter, n, aors):
+    if n % 8 != 0:
+        raise ValueError('expected n to be a multiple of 8')
+
+    reg_a = emitter.take_arg_reg(index=0, write=False)
+    reg_b = emitter.take_arg_reg(index=1, write=False)
+    reg_mask = emitter.take_arg_reg(index=2, write=False)
+
+    reg_g = emitter.reg_store.take(write=True)
+    reg_p = emitter.reg_store.take(write=True)
+    # Carry between the chunks, either 0 or 1.
+    ret = emitter.take_retval_reg(may_overwrite_taken=False)
+
+    vec_mask = emitter.take_vector_reg('zmm')
+    vec_ones = emitter.take_vector_reg('zmm')
+    vec_b = emitter.take_vector_reg('zmm')
+    vec_res = emitter.take_vector_reg('zmm')
+    k_g = emitter.take_mask_reg()
+    k_p = emitter.take_mask_reg()
+
+    emitter.emit(f'vpbroadcastq {reg_mask}, {vec_mask}')
+    emitter.emit(f'vpternlogq $0xff, {vec_ones}, {vec_ones}, {vec_ones}')
+
+    a = PointerReg(reg_a)
+    b = PointerReg(reg_b)
+
+    for i in range(0, n, 8):
+        emitter.emit(f'vpandq {b.displace(i)}, {vec_mask}, {vec_b}')
+        if aors is AORS_ADD:
+            emitter.emit(f'vpaddq {a.displace(i)}, {vec_b}, {vec_res}')
+            emitter.emit(f'vpcmpuq $1, {vec_b}, {vec_res}, {k_g}')
+            emitter.emit(f'vpcmpeqq {vec_ones}, {vec_res}, {k_p}')
+        else:
+            emitter.emit(f'vmovdqu64 {a.displace(i)}, {vec_res}')
+            emitter.emit(f'vpcmpuq $1, {vec_b}, {vec_res}, {k_g}')
+            emitter.emit(f'vpsubq {vec_b}, {vec_res}, {vec_res}')
+            emitter.emit(f'vptestnmq {vec_res}, {vec_res}, {k_p}')
+
+        emitter.emit(f'kmovw {k_g}, {reg_g.e_part()}')
+        emitter.emit(f'kmovw {k_p}, {reg_p.e_part()}')
+        if i:
+            emitter.emit(f'leal ({ret}, {reg_g}, 2), {ret.e_part()}')
+        else:
+            emitter.emit(f'leal ({reg_g}, {reg_g}), {ret.e_part()}')
+        emitter.emit(f'addl {reg_p.e_part()}, {ret.e_part()}')
+        emitter.emit(f'xorl {reg_p.e_part()}, {ret.e_part()}')
+        emitter.emit(f'kmovw {ret.e_part()}, {k_g}')
+        emitter.emit(f'shrl $8, {ret.e_part()}')
+
+        # Adding a carry is subtracting -1, and vice versa.
+        if aors is AORS_ADD:
+            emitter.emit(f'vpsubq {vec_ones}, {vec_res}, {vec_res}{{{k_g}}}')
+        else:
+            emitter.emit(f'vpaddq {vec_ones}, {vec_res}, {vec_res}{{{k_g}}}')
+        emitter.emit(f'vmovdqu64 {vec_res}, {a.displace(i)}')
+
+    emitter.emit_vzeroupper()
+    emitter.emit(f'negq {ret}')
+
+
 def FUNC_aors_q(emitter, n, aors, leaky=False):
     reg_a = emitter.take_arg_reg(index=0, write=False)
     reg_b = emitter.take_arg_reg(index=1, write=False)
 
-    zero = '$0'
+    zero = emitter.take_zero_reg() if n > 1 else '$0'
 
     a = PointerReg(reg_a)
 
     if leaky and n > 2:
-        label_done = emitter.gen_label()
+        # A GAS numeric local label: it does not need a unique name, and all the jumps to it are
+        # short forward ones.
+        label_done = '1'
     else:
         label_done = None
 
@@ -971,7 +1391,7 @@ def FUNC_aors_q(emitter, n, aors, leaky=False):
         if i:
             emitter.emit(f'{aors.ADCSBB}q {zero}, {a.displace(i)}')
             if (label_done is not None) and (i != n - 1):
-                emitter.emit(f'jnc {label_done}')
+                emitter.emit(f'jnc {label_done}f')
         else:
             emitter.emit(f'{aors.ADDSUB}q {reg_b}, {a.displace(i)}')
             # We don't want to emit a 'jnc {label_done}' here since the probability of having a
@@ -991,12 +1411,14 @@ def FUNC_negate(emitter, n):
 
     reg_tmp = emitter.reg_store.take(write=True)
 
+    zero = emitter.take_zero_reg() if n > 1 else '$0'
+
     a = PointerReg(reg_a)
     b = PointerReg(reg_b)
 
     for i in range(n):
         if i:
-            emitter.emit(f'movq $0, {reg_tmp}')
+            emitter.emit(f'movq {zero}, {reg_tmp}')
             emitter.emit(f'sbbq {a.displace(i)}, {reg_tmp}')
         else:
             emitter.emit(f'movq {a.displace(i)}, {reg_tmp}')
@@ -1013,6 +1435,12 @@ def FUNC_cmplt(emitter, n, is_signed=False):
 
     reg_tmp = emitter.reg_store.take(write=True)
 
+    if is_signed:
+        # Zero 'ret' before the flags are computed so that no zero extension is needed after
+        # 'setl'.
+        ret = emitter.take_retval_reg(may_overwrite_taken=False)
+        emitter.emit(f'xorl {ret.e_part()}, {ret.e_part()}')
+
     a = PointerReg(reg_a)
     b = PointerReg(reg_b)
 
@@ -1023,11 +1451,12 @@ def FUNC_cmplt(emitter, n, is_signed=False):
         else:
             emitter.emit(f'subq {b.displace(i)}, {reg_tmp}')
 
-    ret = emitter.take_retval_reg()
     if is_signed:
         emitter.emit(f'setl {ret.l_part()}')
-        emitter.emit(f'movzbq {ret.l_part()}, {ret}')
     else:
+        # The borrow becomes 0 or -1 in a single instruction; 'setb', 'movzbq' and 'negq' would
+        # take three.
+        ret = emitter.take_retval_reg()
         emitter.emit(f'sbbq {ret}, {ret}')
 
 
@@ -1037,6 +1466,12 @@ def FUNC_cmple(emitter, n, is_signed=False):
 
     reg_tmp = emitter.reg_store.take(write=True)
 
+    if is_signed:
+        # Zero 'ret' before the flags are computed so that no zero extension is needed after
+        # 'setge'.
+        ret = emitter.take_retval_reg(may_overwrite_taken=False)
+        emitter.emit(f'xorl {ret.e_part()}, {ret.e_part()}')
+
     a = PointerReg(reg_a)
     b = PointerReg(reg_b)
 
@@ -1047,11 +1482,10 @@ def FUNC_cmple(emitter, n, is_signed=False):
         else:
             emitter.emit(f'subq {a.displace(i)}, {reg_tmp}')
 
-    ret = emitter.take_retval_reg()
     if is_signed:
         emitter.emit(f'setge {ret.l_part()}')
-        emitter.emit(f'movzbq {ret.l_part()}, {ret}')
     else:
+        ret = emitter.take_retval_reg()
         emitter.emit(f'sbbq {ret}, {ret}')
         emitter.emit(f'notq {ret}')
 
@@ -1080,52 +1514,94 @@ def FUNC_cmpeq(emitter, n):
     emitter.emit(f'sbbq {ret}, {ret}')
 
 
-def cond_shr_words(n, amount, assign_callback, cond):
+# Below this width, the AVX2 version is hardly faster than the scalar one at throughput, and slower
+# at latency: the 'vptest' and the move back to a general-purpose register eat what the wider loads
+# save.
+CMPEQ_AVX2_MIN_WIDTH = 8
+
+
+# Same as 'FUNC_cmpeq', but compares four limbs per instruction. If 'n' is not a multiple of four,
+# the last chunk overlaps the previous one rather than falling back to scalar code.
+def FUNC_cmpeq_avx2(emitter, n):
+    if n < 4:
+        raise ValueError('expected n >= 4')
+
+    reg_a = emitter.take_arg_reg(index=0, write=False)
+    reg_b = emitter.take_arg_reg(index=1, write=False)
+
+    ret = emitter.take_retval_reg(may_overwrite_taken=False)
+    emitter.emit(f'xorl {ret.e_part()}, {ret.e_part()}')
+
+    vec_acc = emitter.take_vector_reg()
+    vec_tmp = emitter.take_vector_reg()
+
+    a = PointerReg(reg_a)
+    b = PointerReg(reg_b)
+
+    offsets = list(range(0, n - 3, 4))
+    if n % 4:
+        offsets.append(n - 4)
+
+    for k, i in enumerate(offsets):
+        vec_dst = vec_tmp if k else vec_acc
+        emitter.emit(f'vmovdqu {a.displace(i)}, {vec_dst}')
+        emitter.emit(f'vpxor {b.displace(i)}, {vec_dst}, {vec_dst}')
+        if k:
+            emitter.emit(f'vpor {vec_tmp}, {vec_acc}, {vec_acc}')
+
+    emitter.emit(f'vptest {vec_acc}, {vec_acc}')
+    emitter.emit_vzeroupper()
+    emitter.emit(f'sete {ret.l_part()}')
+    emitter.emit(f'negq {ret}')
+
+
+# Returns the '(src_i, dst_i)' moves of a pass that shifts words '0...n-1' (for a left shift,
+# 'lo...n-1') by 'amount', in an order that reads every word before overwriting it; 'src_i' is None
+# where the fill is shifted in.
+def shr_words_moves(n, amount):
+    moves = []
     for i in range(n):
         src_i = i + amount
-        if src_i >= n:
-            assign_callback(src_i=None, dst_i=i, cond=cond)
-        else:
-            assign_callback(src_i=src_i, dst_i=i, cond=cond)
+        moves.append((src_i if src_i < n else None, i))
+    return moves
 
 
-def cond_shl_words(n, amount, assign_callback, cond):
-    for i in reversed(range(n)):
+def shl_words_moves(n, amount, lo=0):
+    moves = []
+    for i in reversed(range(lo, n)):
         src_i = i - amount
-        if src_i < 0:
-            assign_callback(src_i=None, dst_i=i, cond=cond)
-        else:
-            assign_callback(src_i=src_i, dst_i=i, cond=cond)
+        moves.append((src_i if src_i >= lo else None, i))
+    return moves
 
 
-def dumb_shr_words(emitter, reg_b, n, assign_callback):
+def dumb_shr_words(emitter, reg_b, n):
     for i in range(n):
         if i:
             emitter.emit(f'cmpq ${i}, {reg_b}')
         else:
             emitter.emit(f'testq {reg_b}, {reg_b}')
-        cond_shr_words(n=n - i, amount=1, assign_callback=assign_callback, cond='a')
+        yield 'a', shr_words_moves(n - i, 1)
 
 
-def dumb_shl_words(emitter, reg_b, n, assign_callback):
+def dumb_shl_words(emitter, reg_b, n):
     for i in range(n):
         if i:
             emitter.emit(f'cmpq ${i}, {reg_b}')
         else:
             emitter.emit(f'testq {reg_b}, {reg_b}')
+        yield 'a', shl_words_moves(n, 1, lo=i)
 
-        def new_assign_callback(src_i, dst_i, cond):
-            dst_i += i
-            if src_i is not None:
-                src_i += i
-            assign_callback(src_i=src_i, dst_i=dst_i, cond=cond)
-
-        cond_shl_words(n=n - i, amount=1, assign_callback=new_assign_callback, cond='a')
 
-
-def fancy_shift_words(emitter, reg_b, n, cond_shx_words, assign_callback):
-    def perform_pass(cond, amount):
-        cond_shx_words(n=n, amount=amount, assign_callback=assign_callback, cond=cond)
+def fancy_shift_words(emitter, reg_b, n, shx_words_moves):
+    # If 'n' is not a power of two, the passes below can shift by 'n' already, so clamping the
+    # count to 'n' (three instructions) is cheaper than the final pass (three per word).
+    clamp = (n & (n - 1)) != 0
+    if clamp:
+        reg_clamped = emitter.reg_store.take(write=True)
+        emitter.emit(f'movl ${n}, {reg_clamped.e_part()}')
+        emitter.emit(f'cmpq ${n}, {reg_b}')
+        emitter.emit(f'cmovbq {reg_b}, {reg_clamped}')
+        reg_b = reg_clamped
 
     i = 0
     while True:
@@ -1133,14 +1609,19 @@ def fancy_shift_words(emitter, reg_b, n, cond_shx_words, assign_callback):
         if bit >= n:
             break
         emitter.emit(f'testq ${bit}, {reg_b}')
-        perform_pass(cond='nz', amount=bit)
+        yield 'nz', shx_words_moves(n, bit)
         i += 1
 
-    emitter.emit(f'cmpq ${n - 1}, {reg_b}')
-    perform_pass(cond='a', amount=n)
+    if clamp:
+        emitter.reg_store.untake(reg_clamped)
+    else:
+        emitter.emit(f'cmpq ${n - 1}, {reg_b}')
+        yield 'a', shx_words_moves(n, n)
 
 
-def shift_words_auto(emitter, reg_b, n, direction, assign_callback):
+# Generates the passes of a shift by 'reg_b' words: emits the instruction setting the flags for each
+# pass, then yields '(cond, moves)'; every move must be done with 'cmov{cond}q'.
+def shift_words_passes(emitter, reg_b, n, direction):
     if direction == 'left':
         left = True
     elif direction == 'right':
@@ -1148,16 +1629,58 @@ def shift_words_auto(emitter, reg_b, n, direction, assign_callback):
     else:
         raise ValueError('expected either "left" or "right" as direction')
 
-    if n <= 8:
+    # Up to this width, the 'n' single-word passes emit fewer instructions than the log-n ones
+    # (which also need a register to clamp the count for most widths).
+    if n <= 5:
         if left:
-            dumb_shl_words(emitter, reg_b, n, assign_callback)
+            return dumb_shl_words(emitter, reg_b, n)
         else:
-            dumb_shr_words(emitter, reg_b, n, assign_callback)
+            return dumb_shr_words(emitter, reg_b, n)
     else:
         if left:
-            fancy_shift_words(emitter, reg_b, n, cond_shl_words, assign_callback)
+            return fancy_shift_words(emitter, reg_b, n, shl_words_moves)
         else:
-            fancy_shift_words(emitter, reg_b, n, cond_shr_words, assign_callback)
+            return fancy_shift_words(emitter, reg_b, n, shr_words_moves)
+
+
+# Shifts '{a, n}' by 'reg_b' words, writing the result into '{c, n}' one word at a time.
+def shift_words_in_mem(emitter, a, c, reg_b, n, direction, reg_fill):
+    reg_tmp = emitter.reg_store.take(write=True)
+
+    # Bit 'i' is set once 'c[i]' has been written to.
+    written_to_c_mask = 0
+
+    for cond, moves in shift_words_passes(emitter, reg_b, n, direction):
+        for src_i, dst_i in moves:
+            if (written_to_c_mask >> dst_i) & 1:
+                emitter.emit(f'movq {c.displace(dst_i)}, {reg_tmp}')
+            else:
+                emitter.emit(f'movq {a.displace(dst_i)}, {reg_tmp}')
+            # Even if the fill is shifted in, the old value has to be loaded and stored back: the
+            # pass is conditional, so the word is only replaced if the count says so.
+            if src_i is None:
+                emitter.emit(f'cmov{cond}q {reg_fill}, {reg_tmp}')
+            elif (written_to_c_mask >> src_i) & 1:
+                emitter.emit(f'cmov{cond}q {c.displace(src_i)}, {reg_tmp}')
+            else:
+                emitter.emit(f'cmov{cond}q {a.displace(src_i)}, {reg_tmp}')
+            emitter.emit(f'movq {reg_tmp}, {c.displace(dst_i)}')
+
+            written_to_c_mask |= 1 << dst_i
+
+    assert written_to_c_mask == (1 << n) - 1
+
+    emitter.reg_store.untake(reg_tmp)
+
+
+# Shifts the limbs held in 'tmp_regs' by 'reg_b' words in place.
+def shift_words_in_regs(emitter, tmp_regs, reg_b, direction, reg_fill):
+    for cond, moves in shift_words_passes(emitter, reg_b, len(tmp_regs), direction):
+        for src_i, dst_i in moves:
+            if src_i is None:
+                emitter.emit(f'cmov{cond}q {reg_fill}, {tmp_regs[dst_i]}')
+            else:
+                emitter.emit(f'cmov{cond}q {tmp_regs[src_i]}, {tmp_regs[dst_i]}')
 
 
 def FUNC_shift_words(emitter, n, direction, is_signed, m=8):
@@ -1176,34 +1699,91 @@ def FUNC_shift_words(emitter, n, direction, is_signed, m=8):
         else:
             reg_fill = emitter.take_zero_reg()
 
-        reg_tmp = emitter.reg_store.take(write=True)
+        shift_words_in_mem(emitter, a, c, reg_b, n, direction, reg_fill)
 
-        written_to_c_at = [False for _ in range(n)]
+    else:
+        tmp_regs = [emitter.reg_store.take(write=True) for _ in range(n)]
+        emitter.emit_many(f'movq {a.displace(i)}, {tmp_regs[i]}' for i in range(n))
 
-        def get_ptr(i):
-            if written_to_c_at[i]:
-                return c.displace(i)
-            else:
-                return a.displace(i)
+        if is_signed:
+            reg_fill = emitter.reg_store.take(write=True)
+            emitter.emit(f'movq {tmp_regs[-1]}, {reg_fill}')
+            emitter.emit(f'sarq $63, {reg_fill}')
+        else:
+            reg_fill = emitter.take_zero_reg()
 
-        def assign_callback(src_i, dst_i, cond):
-            emitter.emit(f'movq {get_ptr(dst_i)}, {reg_tmp}')
-            if src_i is None:
-                emitter.emit(f'cmov{cond}q {reg_fill}, {reg_tmp}')
-            else:
-                emitter.emit(f'cmov{cond}q {get_ptr(src_i)}, {reg_tmp}')
-            emitter.emit(f'movq {reg_tmp}, {c.displace(dst_i)}')
+        shift_words_in_regs(emitter, tmp_regs, reg_b, direction, reg_fill)
+
+        emitter.emit_many(f'movq {tmp_regs[i]}, {c.displace(i)}' for i in range(n))
+
+
+# Shifts by an arbitrary number of bits: the word part of the count goes through the same cmov
+# passes as 'FUNC_shift_words', then a single shrd/shld chain does the rest. Unlike the
+# shrx/shlx sequence of 'do_shr'/'do_shl', shrd/shld are correct for a zero bit count, so they
+# are used even if BMI2 is available.
+def FUNC_shift_bits(emitter, n, direction, is_signed, m=4):
+    if direction == 'left':
+        left = True
+    elif direction == 'right':
+        left = False
+    else:
+        raise ValueError('expected either "left" or "right" as direction')
+
+    emitter.add_fixed_reg('rcx')
+
+    reg_a = emitter.take_arg_reg(index=0, write=False)
+    reg_count = emitter.take_arg_reg(index=1, write=False, into_reg_name='rcx')
+    reg_c = emitter.take_arg_reg(index=2, write=False)
+
+    a = PointerReg(reg_a)
+    c = PointerReg(reg_c)
+
+    reg_words = emitter.reg_store.take(write=True)
+    emitter.emit(f'movq {reg_count}, {reg_words}')
+    emitter.emit(f'shrq $6, {reg_words}')
+
+    def shift_bits(src, reg_dst, reg_donor):
+        if left:
+            do_shl(
+                emitter, src=src, reg_dst=reg_dst, reg_donor=reg_donor, reg_count=reg_count,
+                reg_neg_count=None, reg_scratch=None, use_bmi2=False)
+        else:
+            do_shr(
+                emitter, src=src, reg_dst=reg_dst, reg_donor=reg_donor, reg_count=reg_count,
+                reg_neg_count=None, reg_scratch=None, is_signed=is_signed, use_bmi2=False)
+
+    if left:
+        order = list(reversed(range(n)))
+    else:
+        order = list(range(n))
 
-            written_to_c_at[dst_i] = True
+    if n > m:
+        if is_signed:
+            reg_fill = emitter.reg_store.take(write=True)
+            emitter.emit(f'movq {a.displace(n - 1)}, {reg_fill}')
+            emitter.emit(f'sarq $63, {reg_fill}')
+        else:
+            reg_fill = emitter.take_zero_reg()
 
-        shift_words_auto(emitter, reg_b, n, direction, assign_callback)
+        shift_words_in_mem(emitter, a, c, reg_words, n, direction, reg_fill)
 
-        assert all(written_to_c_at)
+        # Now shift '{c, n}' in place, as 'FUNC_shr'/'FUNC_shl' do.
+        reg_tmp_1 = emitter.reg_store.take(write=True)
+        reg_tmp_2 = emitter.reg_store.take(write=True)
+        emitter.emit(f'movq {c.displace(order[0])}, {reg_tmp_1}')
+        for k, i in enumerate(order):
+            if k == n - 1:
+                cur_donor = None
+            else:
+                emitter.emit(f'movq {c.displace(order[k + 1])}, {reg_tmp_2}')
+                cur_donor = reg_tmp_2
+            shift_bits(src=reg_tmp_1, reg_dst=reg_tmp_1, reg_donor=cur_donor)
+            emitter.emit(f'movq {reg_tmp_1}, {c.displace(i)}')
+            reg_tmp_1, reg_tmp_2 = reg_tmp_2, reg_tmp_1
 
     else:
         tmp_regs = [emitter.reg_store.take(write=True) for _ in range(n)]
-        for i in range(n):
-            emitter.emit(f'movq {a.displace(i)}, {tmp_regs[i]}')
+        emitter.emit_many(f'movq {a.displace(i)}, {tmp_regs[i]}' for i in range(n))
 
         if is_signed:
             reg_fill = emitter.reg_store.take(write=True)
@@ -1212,16 +1792,16 @@ def FUNC_shift_words(emitter, n, direction, is_signed, m=8):
         else:
             reg_fill = emitter.take_zero_reg()
 
-        def assign_callback(src_i, dst_i, cond):
-            if src_i is None:
-                emitter.emit(f'cmov{cond}q {reg_fill}, {tmp_regs[dst_i]}')
-            else:
-                emitter.emit(f'cmov{cond}q {tmp_regs[src_i]}, {tmp_regs[dst_i]}')
+        shift_words_in_regs(emitter, tmp_regs, reg_words, direction, reg_fill)
 
-        shift_words_auto(emitter, reg_b, n, direction, assign_callback)
+        for k, i in enumerate(order):
+            if k == n - 1:
+                cur_donor = None
+            else:
+                cur_donor = tmp_regs[order[k + 1]]
+            shift_bits(src=tmp_regs[i], reg_dst=tmp_regs[i], reg_donor=cur_donor)
 
-        for i in range(n):
-            emitter.emit(f'movq {tmp_regs[i]}, {c.displace(i)}')
+        emitter.emit_many(f'movq {tmp_regs[i]}, {c.displace(i)}' for i in range(n))
 
 
 #------------------------------------------------------------------------------
@@ -1239,10 +1819,28 @@ def run_process(args):
         return False
 
 
+# Returns the set of CPU flags the kernel reports in /proc/cpuinfo, or None if it is not available.
+@functools.lru_cache(maxsize=None)
+def read_cpuinfo_flags():
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key.strip() == 'flags':
+                    return frozenset(value.split())
+    except OSError:
+        pass
+    return None
+
+
 def check_cap(cap_name):
     override = os.getenv(f'FIWIA_CAP_{cap_name.upper()}')
     if override:
         return bool(int(override))
+    flags = read_cpuinfo_flags()
+    if flags is not None:
+        return cap_name in flags
+    # No /proc/cpuinfo: compile and run a probe instead.
     my_dir = os.path.dirname(os.path.abspath(__file__))
     if not run_process([os.getenv('CC') or 'gcc', f'{my_dir}/check_cap.c', '-o', f'{my_dir}/check_cap']):
         raise ValueError('cannot compile check_cap')
@@ -1257,13 +1855,6 @@ def check_cap_cached(cap_name):
     return result
 
 
-def choose_plain_or_bmi2(func_plain, func_bmi2, *args, **kwargs):
-    if check_cap_cached('bmi2'):
-        return func_bmi2(*args, **kwargs)
-    else:
-        return func_plain(*args, **kwargs)
-
-
 class GeneratedFunc:
     def __init__(self, name, proto, callback):
         # C function name
@@ -1279,6 +1870,12 @@ class GeneratedFunc:
 
         self.callback = callback
 
+        # C types of the parameters and of the return value, parsed from 'proto'.
+        param_list, retval = parse_proto(proto)
+        self.c_param_types = [proto2c_type(t) for t in param_list]
+        self.c_retval = proto2c_type(retval)
+        self.is_void = (self.c_retval == 'void')
+
 
 PREFIX = 'asm'
 
@@ -1286,6 +1883,30 @@ PREFIX = 'asm'
 def get_generated_funcs(n, is_inline_asm):
     aors_masked_m = 8 if is_inline_asm else 4
     shift_words_m = 8 if is_inline_asm else 4
+    # Fewer registers than for 'shift_words': the count is pinned to '%rcx', and the word count
+    # needs a register of its own (plus one more to clamp it, from width 6 on).
+    shift_bits_m = 5 if is_inline_asm else 4
+
+    has_bmi2 = check_cap_cached('bmi2')
+    has_adx = has_bmi2 and check_cap_cached('adx')
+
+    if has_adx:
+        func_mul, func_mul_lo = FUNC_mul_adx, FUNC_mul_lo_adx
+    elif has_bmi2:
+        func_mul, func_mul_lo = FUNC_mul_bmi2, FUNC_mul_lo_bmi2
+    else:
+        func_mul, func_mul_lo = FUNC_mul, FUNC_mul_lo
+    func_mul_q = FUNC_mul_q_bmi2 if has_bmi2 else FUNC_mul_q
+
+    if n >= CMPEQ_AVX2_MIN_WIDTH and check_cap_cached('avx2'):
+        func_cmpeq = FUNC_cmpeq_avx2
+    else:
+        func_cmpeq = FUNC_cmpeq
+
+    if n % 8 == 0 and n >= AORS_MASKED_AVX512_MIN_WIDTH and check_cap_cached('avx512f'):
+        func_aors_masked = FUNC_aors_masked_avx512
+    else:
+        func_aors_masked = functools.partial(FUNC_aors_masked, m=aors_masked_m)
     return [
         GeneratedFunc(
             name=f'{PREFIX}_add_{n}',
@@ -1298,11 +1919,11 @@ def get_generated_funcs(n, is_inline_asm):
         GeneratedFunc(
             name=f'{PREFIX}_add_masked_{n}',
             proto='#*, @#*, # -> #',
-            callback=lambda emitter: FUNC_aors_masked(emitter, n, AORS_ADD, m=aors_masked_m)),
+            callback=lambda emitter: func_aors_masked(emitter, n, AORS_ADD)),
         GeneratedFunc(
             name=f'{PREFIX}_sub_masked_{n}',
             proto='#*, @#*, # -> #',
-            callback=lambda emitter: FUNC_aors_masked(emitter, n, AORS_SUB, m=aors_masked_m)),
+            callback=lambda emitter: func_aors_masked(emitter, n, AORS_SUB)),
         GeneratedFunc(
             name=f'{PREFIX}_negate_{n}',
             proto='@#*, #* -> #',
@@ -1345,40 +1966,40 @@ def get_generated_funcs(n, is_inline_asm):
         GeneratedFunc(
             name=f'{PREFIX}_cmpeq_{n}',
             proto='@#*, @#* -> #',
-            callback=lambda emitter: FUNC_cmpeq(emitter, n)),
+            callback=lambda emitter: func_cmpeq(emitter, n)),
         GeneratedFunc(
             name=f'{PREFIX}_mul_q_{n}',
             proto='@#*, #, #* -> #',
-            callback=lambda emitter: choose_plain_or_bmi2(FUNC_mul_q, FUNC_mul_q_bmi2, emitter, n)),
+            callback=lambda emitter: func_mul_q(emitter, n)),
         GeneratedFunc(
             name=f'{PREFIX}_div_q_{n}',
             proto='@#*, #, #* -> #',
-            callback=lambda emitter: FUNC_div_q(emitter, n)),
+            callback=lambda emitter: FUNC_div_q(emitter, n, leaky=True)),
         GeneratedFunc(
             name=f'{PREFIX}_mod_q_{n}',
             proto='@#*, # -> #',
-            callback=lambda emitter: FUNC_div_q(emitter, n, operation='mod')),
+            callback=lambda emitter: FUNC_div_q(emitter, n, operation='mod', leaky=True)),
         GeneratedFunc(
             name=f'{PREFIX}_mul_lo_{n}',
             proto='@#*, @#*, #* -> void',
-            callback=lambda emitter: choose_plain_or_bmi2(FUNC_mul_lo, FUNC_mul_lo_bmi2, emitter, n)),
+            callback=lambda emitter: func_mul_lo(emitter, n)),
         GeneratedFunc(
             name=f'{PREFIX}_mul_{n}',
             proto='@#*, @#*, #* -> void',
-            callback=lambda emitter: choose_plain_or_bmi2(FUNC_mul, FUNC_mul_bmi2, emitter, n, n)),
+            callback=lambda emitter: func_mul(emitter, n, n)),
 
         GeneratedFunc(
             name=f'{PREFIX}_shr_nz_{n}',
             proto='@#*, #, #* -> void',
-            callback=lambda emitter: FUNC_shr(emitter, n, use_bmi2=check_cap_cached('bmi2'))),
+            callback=lambda emitter: FUNC_shr(emitter, n, use_bmi2=has_bmi2)),
         GeneratedFunc(
             name=f'{PREFIX}_S_shr_nz_{n}',
             proto='@#*, #, #* -> void',
-            callback=lambda emitter: FUNC_shr(emitter, n, is_signed=True, use_bmi2=check_cap_cached('bmi2'))),
+            callback=lambda emitter: FUNC_shr(emitter, n, is_signed=True, use_bmi2=has_bmi2)),
         GeneratedFunc(
             name=f'{PREFIX}_shl_nz_{n}',
             proto='@#*, #, #* -> void',
-            callback=lambda emitter: FUNC_shl(emitter, n, use_bmi2=check_cap_cached('bmi2'))),
+            callback=lambda emitter: FUNC_shl(emitter, n, use_bmi2=has_bmi2)),
 
         GeneratedFunc(
             name=f'{PREFIX}_shr_{n}',
@@ -1408,6 +2029,22 @@ def get_generated_funcs(n, is_inline_asm):
             proto='@#*, #, #* -> void',
             callback=lambda emitter: FUNC_shift_words(
                 emitter, n, direction='left', is_signed=False, m=shift_words_m)),
+
+        GeneratedFunc(
+            name=f'{PREFIX}_shr_bits_{n}',
+            proto='@#*, #, #* -> void',
+            callback=lambda emitter: FUNC_shift_bits(
+                emitter, n, direction='right', is_signed=False, m=shift_bits_m)),
+        GeneratedFunc(
+            name=f'{PREFIX}_S_shr_bits_{n}',
+            proto='@#*, #, #* -> void',
+            callback=lambda emitter: FUNC_shift_bits(
+                emitter, n, direction='right', is_signed=True, m=shift_bits_m)),
+        GeneratedFunc(
+            name=f'{PREFIX}_shl_bits_{n}',
+            proto='@#*, #, #* -> void',
+            callback=lambda emitter: FUNC_shift_bits(
+                emitter, n, direction='left', is_signed=False, m=shift_bits_m)),
     ]
 
 
@@ -1417,12 +2054,13 @@ def gen_asm(funcs):
         print()
         print(f'.global {func.name}')
         print(f'.type {func.name}, @function')
-        print(f'.align 32')
+        print('.p2align 4')
         print(f'{func.name}:')
         emitter = SysvAbiFunctionEmitter()
         emitter.emit_prologue()
         func.callback(emitter)
         emitter.emit_epilogue()
+        emitter.flush()
         print('retq')
 
 
@@ -1446,12 +2084,8 @@ def gen_c_header(funcs):
 ''')
 
     for func in funcs:
-        param_list, retval = parse_proto(func.proto)
-
-        c_param_list = ', '.join(proto2c_type(x) for x in param_list)
-        c_retval = proto2c_type(retval)
-
-        print(f'extern {c_retval} {func.name}({c_param_list});')
+        c_param_list = ', '.join(func.c_param_types)
+        print(f'extern {func.c_retval} {func.name}({c_param_list});')
 
 
 def gen_inline_asm(funcs):
@@ -1461,25 +2095,21 @@ def gen_inline_asm(funcs):
     print('#include "asm_config.h"')
 
     for func in funcs:
-        param_list, retval = parse_proto(func.proto)
-
-        c_param_list = ', '.join(f'{proto2c_type(t)} arg{i}' for i, t in enumerate(param_list))
-        c_retval = proto2c_type(retval)
-
-        is_void = (c_retval == 'void')
+        c_param_list = ', '.join(f'{t} arg{i}' for i, t in enumerate(func.c_param_types))
 
         print()
-        print(f'asm_attrs {c_retval} {func.name}({c_param_list})')
+        print(f'asm_attrs {func.c_retval} {func.name}({c_param_list})')
         print('{')
-        if not is_void:
-            print(f'    {c_retval} ret;')
+        if not func.is_void:
+            print(f'    {func.c_retval} ret;')
 
         emitter = InlineAsmEmitter()
         emitter.emit_prologue()
         func.callback(emitter)
         emitter.emit_epilogue()
+        emitter.flush()
 
-        if not is_void:
+        if not func.is_void:
             print('    return ret;')
         print('}')
 
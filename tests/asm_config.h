@@ -0,0 +1 @@
+#define asm_attrs static inline __attribute__((always_inline))
@@ -0,0 +1,107 @@
+// Checks that the inline asm keeps the caller's vector registers intact: the compiler may keep
+// values live in them across the asm statements. Also checks that it does not leave the upper
+// vector state dirty, which would slow down any SSE code the caller runs afterwards.
+#include <cpuid.h>
+#include <immintrin.h>
+#include <stdint.h>
+#include <stdio.h>
+#include "inline_asm_16.h"
+
+#define W 16
+
+static volatile uint64_t seed = 0x0123456789abcdef;
+
+static int failures = 0;
+
+__attribute__((noinline))
+static void check(const char *what, __m256i v0, __m256i v1, __m256i v2, __m256i v3, uint64_t s)
+{
+    __m256i vs[4] = {v0, v1, v2, v3};
+    for (int i = 0; i < 4; ++i) {
+        uint64_t lanes[4];
+        _mm256_storeu_si256((__m256i *) lanes, vs[i]);
+        for (int j = 0; j < 4; ++j) {
+            if (lanes[j] != s + i) {
+                printf("%s: lane %d of vector %d is %016llx, expected %016llx\n",
+                       what, j, i, (unsigned long long) lanes[j], (unsigned long long) (s + i));
+                ++failures;
+            }
+        }
+    }
+}
+
+// Bits of the XINUSE state-component bitmap (XGETBV with ECX = 1) for the upper halves of ymm0-15
+// and the upper halves of zmm0-15; 'vzeroupper' clears both.
+#define XINUSE_UPPER_STATE ((1 << 2) | (1 << 6))
+
+static int has_xinuse(void)
+{
+    unsigned eax, ebx, ecx, edx;
+    return __get_cpuid_count(0xd, 1, &eax, &ebx, &ecx, &edx) && (eax & (1 << 2));
+}
+
+static uint64_t xinuse(void)
+{
+    uint32_t lo, hi;
+    __asm__ volatile ("xgetbv" : "=a" (lo), "=d" (hi) : "c" (1));
+    return ((uint64_t) hi << 32) | lo;
+}
+
+#define CHECK_PRESERVED(call) \
+    do { \
+        uint64_t s = seed; \
+        __m256i v0 = _mm256_set1_epi64x(s); \
+        __m256i v1 = _mm256_set1_epi64x(s + 1); \
+        __m256i v2 = _mm256_set1_epi64x(s + 2); \
+        __m256i v3 = _mm256_set1_epi64x(s + 3); \
+        for (int k = 0; k < 4; ++k) \
+            sink += (call); \
+        check(#call, v0, v1, v2, v3, s); \
+    } while (0)
+
+#define CHECK_CLEAN_UPPER(call) \
+    do { \
+        if (!has_xinuse()) \
+            break; \
+        __asm__ volatile ("vzeroupper"); \
+        sink += (call); \
+        if (xinuse() & XINUSE_UPPER_STATE) { \
+            printf("%s: leaves the upper vector state dirty\n", #call); \
+            ++failures; \
+        } \
+    } while (0)
+
+int main(void)
+{
+    if (!__builtin_cpu_supports("avx2")) {
+        printf("AVX2 is not supported, skipping.\n");
+        return 0;
+    }
+
+    uint64_t a[W];
+    uint64_t b[W];
+    for (int i = 0; i < W; ++i) {
+        a[i] = seed * (i + 1);
+        b[i] = a[i];
+    }
+    uint64_t sink = 0;
+
+    CHECK_PRESERVED(asm_cmpeq_16(a, b));
+    CHECK_CLEAN_UPPER(asm_cmpeq_16(a, b));
+
+    if (__builtin_cpu_supports("avx512f")) {
+        CHECK_PRESERVED(asm_add_masked_16(a, b, -1));
+        CHECK_PRESERVED(asm_sub_masked_16(a, b, -1));
+        CHECK_CLEAN_UPPER(asm_add_masked_16(a, b, -1));
+        CHECK_CLEAN_UPPER(asm_sub_masked_16(a, b, -1));
+    } else {
+        printf("AVX-512 is not supported, skipping add_masked/sub_masked.\n");
+    }
+
+    printf("sink: %llx\n", (unsigned long long) sink);
+    if (failures) {
+        printf("FAILED: %d checks\n", failures);
+        return 1;
+    }
+    return 0;
+}